@@ -0,0 +1,374 @@
+"""Compact array-backed storage for bounding box annotations.
+
+Each image's boxes are kept column-wise in NumPy arrays instead of one dict per box:
+normalized coordinates in int16, flag names, referring expressions and sources as ids
+into a shared string table, and timestamps as int64 microseconds. ImageAnnotations
+converts to and from the JSON shape used by the API and annotations.json.
+"""
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+NO_TIMESTAMP = np.iinfo(np.int64).min
+RAW_TIMESTAMP_BASE = NO_TIMESTAMP + 1  # Far below any real datetime in microseconds
+BBOX_ID_LENGTH = 32
+BBOX_ID_DTYPE = f"S{BBOX_ID_LENGTH}"
+
+
+def new_bbox_id() -> str:
+    """Generate a stable bounding box id"""
+    return uuid.uuid4().hex
+
+
+def is_valid_bbox_id(bbox_id) -> bool:
+    """Check that a bbox id fits the fixed-width id column"""
+    return isinstance(bbox_id, str) and 0 < len(bbox_id) <= BBOX_ID_LENGTH and bbox_id.isascii()
+
+
+def has_legacy_bboxes(data: Dict) -> bool:
+    """Check whether an image entry in the JSON shape has boxes without a usable id"""
+    return any(not isinstance(bbox, dict) or not is_valid_bbox_id(bbox.get("id"))
+               for flag_data in data.get("flags", {}).values()
+               for bbox in flag_data.get("bboxes", []))
+
+
+def bbox_error(bbox) -> Optional[str]:
+    """Describe why a box in the JSON shape cannot be stored exactly, or None if it can.
+
+    Coordinates must already be integers in the normalized 1-1000 space; anything
+    else would be changed by to_coordinate_array().
+    """
+    if isinstance(bbox, list):
+        bbox = {"coordinates": bbox}
+    if not isinstance(bbox, dict):
+        return "is not an object"
+    coords = bbox.get("coordinates")
+    if not isinstance(coords, list) or len(coords) != 4:
+        return "does not have 4 coordinates"
+    if not all(isinstance(v, int) and not isinstance(v, bool) and 1 <= v <= 1000 for v in coords):
+        return "has coordinates that are not integers in 1-1000"
+    if not isinstance(bbox.get("ref_exp", ""), str) or not isinstance(bbox.get("source", ""), str):
+        return "has a non-string ref_exp or source"
+    score = bbox.get("score")
+    if score is not None and (not isinstance(score, (int, float)) or isinstance(score, bool)):
+        return "has a non-numeric score"
+    return None
+
+
+def timestamp_to_micros(value: str, strings: "StringTable") -> int:
+    """Encode an ISO timestamp as microseconds since the epoch.
+
+    Only naive timestamps that convert back to exactly the same string (as written
+    by ``datetime.now().isoformat()``) are stored as microseconds. Anything else,
+    such as timezone-aware or non-canonical values, is kept verbatim as a string
+    table id offset into the reserved range just above NO_TIMESTAMP.
+    """
+    if not value:
+        return NO_TIMESTAMP
+    try:
+        micros = (datetime.fromisoformat(value) - EPOCH) // timedelta(microseconds=1)
+        if micros_to_timestamp(micros, strings) == value:
+            return micros
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return RAW_TIMESTAMP_BASE + strings.intern(str(value))
+
+
+def micros_to_timestamp(value: int, strings: "StringTable") -> str:
+    """Decode a value from timestamp_to_micros back to its ISO timestamp"""
+    if value == NO_TIMESTAMP:
+        return ""
+    if is_raw_timestamp(value):
+        return strings[int(value - RAW_TIMESTAMP_BASE)]
+    return (EPOCH + timedelta(microseconds=int(value))).isoformat()
+
+
+def is_raw_timestamp(value) -> bool:
+    """Check whether an encoded timestamp refers to a verbatim string"""
+    return RAW_TIMESTAMP_BASE <= value < RAW_TIMESTAMP_BASE + 2 ** 31
+
+
+class StringTable:
+    """Interned strings shared by all images, addressed by int32 id"""
+
+    def __init__(self):
+        self.values = [""]
+        self.ids = {"": 0}
+        self.compacted_size = 1  # Table size right after the last compaction
+
+    def intern(self, value: str) -> int:
+        """Return the id for a string, adding it if needed"""
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = len(self.values)
+            self.ids[value] = string_id
+            self.values.append(value)
+        return string_id
+
+    def intern_many(self, values: List[str]) -> np.ndarray:
+        """Return ids for a list of strings as an int32 array"""
+        return np.fromiter((self.intern(value) for value in values), dtype=np.int32, count=len(values))
+
+    def __getitem__(self, string_id: int) -> str:
+        return self.values[string_id]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def compact(self, entries, min_growth: int = 1024) -> bool:
+        """Drop strings no longer referenced by any of ``entries`` and renumber the rest.
+
+        Edited referring expressions and deleted boxes leave unused strings behind.
+        Compaction only runs once the table has doubled (plus ``min_growth``) since the
+        last compaction, so its cost stays proportional to the number of writes.
+        ``entries`` must be every ImageAnnotations sharing this table.
+        """
+        if len(self.values) <= 2 * self.compacted_size + min_growth:
+            return False
+        entries = list(entries)
+        live = np.zeros(len(self.values), dtype=bool)
+        live[0] = True
+        for entry in entries:
+            entry.mark_strings(live)
+        remap = (np.cumsum(live) - 1).astype(np.int32)
+        print(f"Compacting string table from {len(self.values)} to {int(live.sum())} strings")
+
+        self.values = [value for value, keep in zip(self.values, live.tolist()) if keep]
+        self.ids = {value: string_id for string_id, value in enumerate(self.values)}
+        self.compacted_size = len(self.values)
+        for entry in entries:
+            entry.remap_strings(remap)
+        return True
+
+
+class ImageAnnotations:
+    """Columnar store for one user's annotations of one image.
+
+    Box rows are kept in insertion order, so the boxes of a flag appear in the
+    order they were added. Flags are listed in ``flag_keys`` with their
+    timestamps in ``flag_times``. A flag may be present with no boxes.
+    """
+
+    __slots__ = ("strings", "version", "last_updated_us", "flag_keys", "flag_times",
+                 "coords", "flag_ids", "ref_exps", "sources", "scores", "bbox_ids")
+
+    def __init__(self, strings: StringTable):
+        self.strings = strings
+        self.version = 0
+        self.last_updated_us = NO_TIMESTAMP
+        self.flag_keys = np.empty(0, dtype=np.int32)
+        self.flag_times = np.empty(0, dtype=np.int64)
+        self.coords = np.empty((0, 4), dtype=np.int16)
+        self.flag_ids = np.empty(0, dtype=np.int32)
+        self.ref_exps = np.empty(0, dtype=np.int32)
+        self.sources = np.empty(0, dtype=np.int32)
+        self.scores = np.empty(0, dtype=np.float64)
+        self.bbox_ids = np.empty(0, dtype=BBOX_ID_DTYPE)
+
+    @classmethod
+    def from_dict(cls, data: Dict, strings: StringTable, strict: bool = False) -> "ImageAnnotations":
+        """Build the store from the JSON shape, upgrading legacy list boxes and missing ids.
+
+        With ``strict``, a ValueError is raised for anything that would not be stored
+        exactly (see bbox_error()); otherwise such boxes are skipped with a warning.
+        """
+        entry = cls(strings)
+        version = data.get("version", 0)
+        if strict and not (isinstance(version, int) and not isinstance(version, bool)):
+            raise ValueError(f"Version {version!r} is not an integer")
+        entry.version = version if isinstance(version, int) else 0
+        if strict:
+            timestamps = [data.get("last_updated", "")]
+            timestamps += [flag_data.get("timestamp", "") for flag_data in data.get("flags", {}).values()]
+            if not all(isinstance(value, str) for value in timestamps):
+                raise ValueError("Timestamps must be strings")
+        entry.last_updated_us = timestamp_to_micros(data.get("last_updated", ""), strings)
+
+        flag_keys, flag_times = [], []
+        coords, flag_ids, ref_exps, sources, scores, bbox_ids = [], [], [], [], [], []
+        for flag_name, flag_data in data.get("flags", {}).items():
+            flag_id = strings.intern(flag_name)
+            flag_keys.append(flag_id)
+            flag_times.append(timestamp_to_micros(flag_data.get("timestamp", ""), strings))
+            for bbox in flag_data.get("bboxes", []):
+                error = bbox_error(bbox)
+                if error:
+                    if strict:
+                        raise ValueError(f"Bounding box {bbox} for {flag_name} {error}")
+                    print(f"Warning: Skipping malformed bbox {bbox} for {flag_name}: {error}")
+                    continue
+                if isinstance(bbox, list):
+                    bbox = {"coordinates": bbox}
+                coords.append(bbox["coordinates"])
+                flag_ids.append(flag_id)
+                ref_exps.append(bbox.get("ref_exp", ""))
+                sources.append(bbox.get("source", ""))
+                scores.append(np.nan if bbox.get("score") is None else bbox["score"])
+                bbox_ids.append(bbox["id"] if is_valid_bbox_id(bbox.get("id")) else new_bbox_id())
+
+        entry.flag_keys = np.array(flag_keys, dtype=np.int32)
+        entry.flag_times = np.array(flag_times, dtype=np.int64)
+        if coords:
+            entry.coords = to_coordinate_array(coords)
+            entry.flag_ids = np.array(flag_ids, dtype=np.int32)
+            entry.ref_exps = strings.intern_many(ref_exps)
+            entry.sources = strings.intern_many(sources)
+            entry.scores = np.array(scores, dtype=np.float64)
+            entry.bbox_ids = np.array(bbox_ids, dtype=BBOX_ID_DTYPE)
+        return entry
+
+    def to_dict(self) -> Dict:
+        """Convert the store to the JSON shape used by the API and annotations.json"""
+        strings = self.strings
+        coords = self.coords.tolist()
+        ref_exps = self.ref_exps.tolist()
+        sources = self.sources.tolist()
+        scores = self.scores.tolist()
+        bbox_ids = self.bbox_ids.tolist()
+
+        flags = {}
+        for flag_id, flag_time in zip(self.flag_keys.tolist(), self.flag_times.tolist()):
+            bboxes = []
+            for row in np.flatnonzero(self.flag_ids == flag_id).tolist():
+                bbox = {
+                    "id": bbox_ids[row].decode("ascii"),
+                    "coordinates": coords[row],
+                    "ref_exp": strings[ref_exps[row]]
+                }
+                if sources[row]:
+                    bbox["source"] = strings[sources[row]]
+                if not np.isnan(scores[row]):  # NaN marks a missing score
+                    bbox["score"] = scores[row]
+                bboxes.append(bbox)
+            flags[strings[flag_id]] = {"bboxes": bboxes, "timestamp": micros_to_timestamp(flag_time, strings)}
+
+        return {"flags": flags, "last_updated": self.last_updated, "version": self.version}
+
+    @property
+    def last_updated(self) -> str:
+        return micros_to_timestamp(self.last_updated_us, self.strings)
+
+    @last_updated.setter
+    def last_updated(self, value: str):
+        self.last_updated_us = timestamp_to_micros(value, self.strings)
+
+    def __len__(self) -> int:
+        return len(self.flag_ids)
+
+    def nbytes(self) -> int:
+        """Bytes held by the arrays of this image (excluding the shared string table)"""
+        return sum(getattr(self, name).nbytes for name in
+                   ("flag_keys", "flag_times", "coords", "flag_ids", "ref_exps", "sources", "scores", "bbox_ids"))
+
+    def mark_strings(self, live: np.ndarray):
+        """Set ``live`` for every string table id this image refers to"""
+        live[self.flag_keys] = True
+        live[self.ref_exps] = True
+        live[self.sources] = True
+        times = np.append(self.flag_times, np.int64(self.last_updated_us))
+        raw = times[(times >= RAW_TIMESTAMP_BASE) & (times < RAW_TIMESTAMP_BASE + 2 ** 31)]
+        live[(raw - RAW_TIMESTAMP_BASE).astype(np.int64)] = True
+
+    def remap_strings(self, remap: np.ndarray):
+        """Renumber string table ids after StringTable.compact"""
+        self.flag_keys = remap[self.flag_keys]
+        self.flag_ids = remap[self.flag_ids]
+        self.ref_exps = remap[self.ref_exps]
+        self.sources = remap[self.sources]
+        raw = (self.flag_times >= RAW_TIMESTAMP_BASE) & (self.flag_times < RAW_TIMESTAMP_BASE + 2 ** 31)
+        if raw.any():
+            self.flag_times = self.flag_times.copy()
+            self.flag_times[raw] = RAW_TIMESTAMP_BASE + remap[self.flag_times[raw] - RAW_TIMESTAMP_BASE].astype(np.int64)
+        if is_raw_timestamp(self.last_updated_us):
+            self.last_updated_us = RAW_TIMESTAMP_BASE + int(remap[self.last_updated_us - RAW_TIMESTAMP_BASE])
+
+    def _flag_position(self, flag_name: str) -> int:
+        flag_id = self.strings.ids.get(flag_name)
+        if flag_id is None:
+            return -1
+        positions = np.flatnonzero(self.flag_keys == flag_id)
+        return int(positions[0]) if len(positions) else -1
+
+    def has_flag(self, flag_name: str) -> bool:
+        return self._flag_position(flag_name) >= 0
+
+    def set_flag_timestamp(self, flag_name: str, timestamp: str):
+        """Set a flag's timestamp, adding the flag if it is not present"""
+        position = self._flag_position(flag_name)
+        if position < 0:
+            self.flag_keys = np.append(self.flag_keys, np.int32(self.strings.intern(flag_name)))
+            self.flag_times = np.append(self.flag_times, np.int64(timestamp_to_micros(timestamp, self.strings)))
+        else:
+            self.flag_times[position] = timestamp_to_micros(timestamp, self.strings)
+
+    def remove_flag(self, flag_name: str):
+        """Remove a flag and all of its boxes"""
+        position = self._flag_position(flag_name)
+        if position < 0:
+            return
+        flag_id = self.flag_keys[position]
+        self.flag_keys = np.delete(self.flag_keys, position)
+        self.flag_times = np.delete(self.flag_times, position)
+        self._keep_rows(self.flag_ids != flag_id)
+
+    def flag_rows(self, flag_name: str) -> np.ndarray:
+        """Row numbers of a flag's boxes, in list order"""
+        flag_id = self.strings.ids.get(flag_name)
+        if flag_id is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.flag_ids == flag_id)
+
+    def find_bbox(self, flag_name: str, bbox_id: Optional[str] = None, bbox_index: Optional[int] = None) -> int:
+        """Locate a flag's box by id (preferred) or by list position, returning the row or -1"""
+        rows = self.flag_rows(flag_name)
+        if bbox_id:
+            if not is_valid_bbox_id(bbox_id):
+                return -1
+            matches = rows[self.bbox_ids[rows] == bbox_id.encode("ascii")]
+            return int(matches[0]) if len(matches) else -1
+        if bbox_index is not None and 0 <= bbox_index < len(rows):
+            return int(rows[bbox_index])
+        return -1
+
+    def bbox_id(self, row: int) -> str:
+        return self.bbox_ids[row].decode("ascii")
+
+    def append_bboxes(self, flag_name: str, coords, bbox_ids: List[str], ref_exps: Optional[List[str]] = None,
+                      sources: Optional[List[str]] = None, scores=None):
+        """Append boxes for a flag in one batch; the flag must already be present"""
+        count = len(bbox_ids)
+        flag_id = self.strings.intern(flag_name)
+        self.coords = np.concatenate([self.coords, to_coordinate_array(coords)])
+        self.flag_ids = np.concatenate([self.flag_ids, np.full(count, flag_id, dtype=np.int32)])
+        self.ref_exps = np.concatenate([self.ref_exps, self.strings.intern_many(ref_exps) if ref_exps
+                                        else np.zeros(count, dtype=np.int32)])
+        self.sources = np.concatenate([self.sources, self.strings.intern_many(sources) if sources
+                                       else np.zeros(count, dtype=np.int32)])
+        self.scores = np.concatenate([self.scores, np.full(count, np.nan) if scores is None
+                                      else np.asarray(scores, dtype=np.float64)])
+        self.bbox_ids = np.concatenate([self.bbox_ids, np.array(bbox_ids, dtype=BBOX_ID_DTYPE)])
+
+    def set_ref_exp(self, row: int, referring_expression: str):
+        self.ref_exps[row] = self.strings.intern(referring_expression)
+
+    def remove_bbox(self, row: int):
+        keep = np.ones(len(self), dtype=bool)
+        keep[row] = False
+        self._keep_rows(keep)
+
+    def _keep_rows(self, keep: np.ndarray):
+        self.coords = self.coords[keep]
+        self.flag_ids = self.flag_ids[keep]
+        self.ref_exps = self.ref_exps[keep]
+        self.sources = self.sources[keep]
+        self.scores = self.scores[keep]
+        self.bbox_ids = self.bbox_ids[keep]
+
+
+def to_coordinate_array(coords) -> np.ndarray:
+    """Round and clamp coordinates into the normalized 1-1000 space as an (n, 4) int16 array"""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+    return np.clip(np.rint(np.nan_to_num(coords, nan=1.0)), 1, 1000).astype(np.int16)
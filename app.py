@@ -3,15 +3,23 @@ from flask_cors import CORS
 import json
 import os
 import random
+import re
 import sys
 import argparse
+import hashlib
 from datetime import datetime
 from typing import List, Dict, Tuple, Optional
+from collections import OrderedDict
+import threading
 import cv2
 import numpy as np
 from PIL import Image, ImageDraw
 import base64
 import io
+from annotation_store import (BBOX_ID_DTYPE, BBOX_ID_LENGTH, ImageAnnotations, StringTable, has_legacy_bboxes,
+                              is_valid_bbox_id, new_bbox_id)
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this in production
@@ -26,9 +34,17 @@ class AnnotationSystem:
         self.images_dir = None  # Will be set when user folder is loaded
         self.sample_images = []
         self.users = {}
-        self.annotations = {}
+        self.annotations = {}  # email -> image name -> ImageAnnotations
+        self.strings = StringTable()  # Interned flag names, referring expressions and sources
         self.user_folder_path = user_folder_path  # Path to user folder (e.g., sft_splits/user1)
         self.user_metadata = {}  # Metadata for current user's images
+        self.write_lock = threading.RLock()  # Serializes annotation mutations
+        self.idempotency_results = OrderedDict()  # (email, idempotency key) -> write result
+        self.max_idempotency_results = 10000
+        self.file_offsets = {}  # (email, image name) -> byte range of its JSON in annotations.json
+        self.dirty_images = set()  # (email, image name) changed since annotations.json was written
+        self.file_identity = None  # (inode, size, mtime) of annotations.json when file_offsets were recorded
+        self.raw_images = {}  # (email, image name) -> JSON text of images that cannot be stored exactly (read-only)
         
         # Flag definitions with explanations
         self.flags = {
@@ -128,20 +144,165 @@ class AnnotationSystem:
         
         if os.path.exists(self.annotations_file):
             with open(self.annotations_file, 'r') as f:
-                self.annotations = json.load(f)
+                text = f.read()
+                file_identity = self._file_identity(os.fstat(f.fileno()))
+            # Offsets double as byte offsets for the next incremental save only if the file is ASCII
+            track_offsets = text.isascii()
+            if track_offsets:
+                self.file_identity = file_identity
+            
+            # Convert to columnar stores image by image so only one image is ever parsed to dicts
+            upgraded = False
+            for email, img_name, image_data, start, end in self._iter_annotations_file(text):
+                user_annotations = self.annotations.setdefault(email, {})
+                if img_name is None:
+                    continue
+                try:
+                    image_entry = ImageAnnotations.from_dict(image_data, self.strings, strict=True)
+                except (ValueError, TypeError, AttributeError) as e:
+                    # Keep the stored JSON untouched and show what can be read
+                    print(f"Warning: Annotations for {img_name} ({email}) are kept read-only: {e}")
+                    self.raw_images[(email, img_name)] = text[start:end]
+                    user_annotations[img_name] = self._load_readable_part(image_data)
+                    continue
+                upgraded = upgraded or has_legacy_bboxes(image_data)
+                user_annotations[img_name] = image_entry
+                if track_offsets:
+                    self.file_offsets[(email, img_name)] = (start, end)
+                # Images normalized on load (new ids, legacy lists, clamped coordinates) must be re-serialized
+                if image_entry.to_dict() != image_data:
+                    self.dirty_images.add((email, img_name))
+            del text
+            
+            # Persist newly assigned bbox ids right away so they stay stable across restarts;
+            # read-only images are written back verbatim
+            if upgraded:
+                print("Assigned ids to legacy bounding boxes, saving upgraded annotations")
+                self.save_data()
+    
+    def _load_readable_part(self, image_data) -> ImageAnnotations:
+        """Build a store from whatever part of a malformed image entry can be read"""
+        try:
+            return ImageAnnotations.from_dict(image_data, self.strings)
+        except (ValueError, TypeError, AttributeError):
+            return ImageAnnotations(self.strings)
+    
+    @staticmethod
+    def _file_identity(stat: os.stat_result) -> Tuple[int, int, int]:
+        """Identify a version of a file, to detect rewrites by another process"""
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+    
+    def _iter_annotations_file(self, text: str):
+        """Yield (email, image name, image data, start, end) for each image in annotations.json.
+        
+        ``start`` and ``end`` are the character offsets of the image's JSON value. Users
+        without images are yielded once with an image name of None.
+        """
+        decoder = json.JSONDecoder()
+        
+        def skip(idx):
+            return JSON_WHITESPACE.match(text, idx).end()
+        
+        def expect(idx, char):
+            idx = skip(idx)
+            if text[idx:idx + 1] != char:
+                raise ValueError(f"Expected '{char}' at position {idx} of {self.annotations_file}")
+            return idx + 1
+        
+        idx = skip(expect(0, "{"))
+        if text[idx:idx + 1] == "}":
+            return
+        while True:
+            email, idx = decoder.raw_decode(text, skip(idx))
+            idx = skip(expect(expect(idx, ":"), "{"))
+            if text[idx:idx + 1] == "}":
+                idx += 1
+                yield email, None, None, 0, 0
+            else:
+                while True:
+                    img_name, idx = decoder.raw_decode(text, skip(idx))
+                    start = skip(expect(idx, ":"))
+                    image_data, idx = decoder.raw_decode(text, start)
+                    yield email, img_name, image_data, start, idx
+                    idx = skip(idx)
+                    if text[idx:idx + 1] != ",":
+                        idx = expect(idx, "}")
+                        break
+                    idx += 1
+            idx = skip(idx)
+            if text[idx:idx + 1] != ",":
+                expect(idx, "}")
+                return
+            idx += 1
     
     def save_data(self):
         """Save users and annotations to files"""
-        print(f"Saving data to {self.users_file} and {self.annotations_file}")
-        print(f"Annotations to save: {self.annotations}")
+        with self.write_lock:
+            print(f"Saving data to {self.users_file} and {self.annotations_file}")
+            print(f"Annotations to save: {sum(len(images) for images in self.annotations.values())} images")
+            
+            # Drop referring expressions left behind by edits and deletions
+            self.strings.compact(image_entry for user_annotations in self.annotations.values()
+                                 for image_entry in user_annotations.values())
+            
+            users_tmp = self.users_file + ".tmp"
+            with open(users_tmp, 'w') as f:
+                json.dump(self.users, f, indent=2)
+            os.replace(users_tmp, self.users_file)
+            
+            self._save_annotations_file()
+            print("Data saved successfully to files")
+    
+    def _save_annotations_file(self):
+        """Write annotations.json atomically, re-serializing only images that changed.
         
-        with open(self.users_file, 'w') as f:
-            json.dump(self.users, f, indent=2)
+        The JSON of an unchanged image is copied byte for byte from the previous file
+        using the offsets recorded when it was written, so a one-box edit does not
+        expand every image to dicts. If the file was replaced since (by the command-line
+        import or another process), the offsets are stale and every image is
+        re-serialized. Read-only images are written back verbatim. The new file is
+        written to a temporary path and swapped in with os.replace, so a crash
+        mid-save leaves the old file intact.
+        """
+        tmp_file = self.annotations_file + ".tmp"
+        previous = None
+        if self.file_offsets and os.path.exists(self.annotations_file):
+            previous = open(self.annotations_file, 'rb')
+            if self._file_identity(os.fstat(previous.fileno())) != self.file_identity:
+                print(f"Warning: {self.annotations_file} changed on disk, re-serializing all images")
+                previous.close()
+                previous = None
         
-        with open(self.annotations_file, 'w') as f:
-            json.dump(self.annotations, f, indent=2)
+        offsets = {}
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(b"{")
+                for user_index, (email, user_annotations) in enumerate(self.annotations.items()):
+                    f.write((("," if user_index else "") + json.dumps(email) + ":{").encode())
+                    for img_index, (img_name, image_entry) in enumerate(user_annotations.items()):
+                        f.write((("," if img_index else "") + json.dumps(img_name) + ":").encode())
+                        key = (email, img_name)
+                        start = f.tell()
+                        if key in self.raw_images:
+                            f.write(self.raw_images[key].encode())
+                        elif previous and key in self.file_offsets and key not in self.dirty_images:
+                            old_start, old_end = self.file_offsets[key]
+                            previous.seek(old_start)
+                            f.write(previous.read(old_end - old_start))
+                        else:
+                            # One-shot dumps uses the C encoder; ensure_ascii keeps bytes == chars
+                            f.write(json.dumps(image_entry.to_dict()).encode())
+                        offsets[key] = (start, f.tell())
+                    f.write(b"}")
+                f.write(b"}")
+        finally:
+            if previous:
+                previous.close()
         
-        print("Data saved successfully to files")
+        os.replace(tmp_file, self.annotations_file)
+        self.file_offsets = offsets
+        self.file_identity = self._file_identity(os.stat(self.annotations_file))
+        self.dirty_images.clear()
     
     def register_user(self, name: str, email: str) -> Tuple[bool, str]:
         """Register a new user"""
@@ -161,8 +322,8 @@ class AnnotationSystem:
             "last_selected_flag": None
         }
         
-        # Initialize empty annotations for this user
-        self.annotations[email] = {}
+        # Initialize empty annotations for this user, keeping any already stored under the email
+        self.annotations.setdefault(email, {})
         
         self.save_data()
         return True, f"User {name} registered successfully!"
@@ -177,164 +338,441 @@ class AnnotationSystem:
     
     def get_image_annotations(self, email: str, img_name: str) -> Dict:
         """Get annotations for a specific image"""
-        if email in self.annotations and img_name in self.annotations[email]:
-            return self.annotations[email][img_name]
-        return {"flags": {}, "last_updated": ""}
+        # Writes replace the column arrays one by one, so reads must not interleave with them
+        with self.write_lock:
+            if email in self.annotations and img_name in self.annotations[email]:
+                return self.annotations[email][img_name].to_dict()
+        return {"flags": {}, "last_updated": "", "version": 0}
     
-    def save_annotation(self, email: str, img_name: str, flag_name: str, bbox) -> Tuple[bool, str]:
-        """Save annotation for a specific flag and image"""
-        print(f"Saving annotation for {email}, {img_name}, {flag_name}, {bbox}")
-        
-        # Create user annotation entry if it doesn't exist
+    def _get_or_create_image_entry(self, email: str, img_name: str) -> ImageAnnotations:
+        """Get the annotation store for an image, creating user/image entries as needed"""
         if email not in self.annotations:
             self.annotations[email] = {}
             print(f"Created new user entry for {email}")
         
         if img_name not in self.annotations[email]:
-            self.annotations[email][img_name] = {"flags": {}, "last_updated": ""}
+            self.annotations[email][img_name] = ImageAnnotations(self.strings)
             print(f"Created new image entry for {img_name}")
         
-        # Initialize flag if it doesn't exist
-        if flag_name not in self.annotations[email][img_name]["flags"]:
-            self.annotations[email][img_name]["flags"][flag_name] = {
-                "bboxes": [],
-                "timestamp": datetime.now().isoformat()
-            }
-            print(f"Created new flag entry for {flag_name}")
+        return self.annotations[email][img_name]
+    
+    def _apply_write(self, email: str, img_name: str, expected_version: Optional[int],
+                     idempotency_key: Optional[str], write) -> Tuple[bool, str, Dict]:
+        """Run a mutation of one image's annotations with version checking and idempotent replay.
+        
+        ``write`` is called with the image's store and returns (success, message, data). For an
+        image with no annotations yet it gets a new store, which is only kept if the write
+        succeeds, so rejected writes never create empty image entries. A write
+        carrying an already-seen idempotency key returns the stored result without being
+        applied again. A write whose ``expected_version`` does not match the image's current
+        version is rejected with the current state so the client can reconcile. Images
+        kept read-only by load_data() reject all writes.
+        """
+        with self.write_lock:
+            if idempotency_key and (email, idempotency_key) in self.idempotency_results:
+                print(f"Replaying result for idempotency key {idempotency_key}")
+                return self.idempotency_results[(email, idempotency_key)]
+            
+            if (email, img_name) in self.raw_images:
+                return False, f"Annotations for {img_name} could not be loaded exactly and are read-only", {}
+            
+            image_entry = self.annotations.get(email, {}).get(img_name)
+            current_version = image_entry.version if image_entry else 0
+            if expected_version is not None and expected_version != current_version:
+                print(f"Version conflict for {email}, {img_name}: expected {expected_version}, current {current_version}")
+                return False, "Annotations were changed elsewhere", {
+                    "conflict": True,
+                    "version": current_version,
+                    "annotations": self.get_image_annotations(email, img_name)
+                }
+            
+            if image_entry is None:
+                image_entry = ImageAnnotations(self.strings)
+            success, message, data = write(image_entry)
+            
+            if success:
+                if img_name not in self.annotations.setdefault(email, {}):
+                    self.annotations[email][img_name] = image_entry
+                    print(f"Created new image entry for {img_name}")
+                image_entry.version += 1
+                self.dirty_images.add((email, img_name))
+                self.save_data()
+            data["version"] = image_entry.version
+            result = (success, message, data)
+            
+            if idempotency_key:
+                self.idempotency_results[(email, idempotency_key)] = result
+                while len(self.idempotency_results) > self.max_idempotency_results:
+                    self.idempotency_results.popitem(last=False)
+            
+            return result
+    
+    def save_annotation(self, email: str, img_name: str, flag_name: str, bbox,
+                        expected_version: Optional[int] = None,
+                        idempotency_key: Optional[str] = None) -> Tuple[bool, str, Dict]:
+        """Save annotation for a specific flag and image"""
+        return self._apply_write(email, img_name, expected_version, idempotency_key,
+                                 lambda image_entry: self._save_annotation(image_entry, email, img_name, flag_name, bbox))
+    
+    def _save_annotation(self, image_entry: ImageAnnotations, email: str, img_name: str, flag_name: str,
+                         bbox) -> Tuple[bool, str, Dict]:
+        print(f"Saving annotation for {email}, {img_name}, {flag_name}, {bbox}")
         
         # Check if this is an update to an existing bbox (has referring expression)
         if isinstance(bbox, dict) and 'referringExpression' in bbox:
             print(f"Processing referring expression update: {bbox}")
-            # This is an update to an existing bbox with referring expression
-            bbox_index = bbox.get('bboxIndex', -1)
-            print(f"Bbox index: {bbox_index}")
-            if bbox_index >= 0 and bbox_index < len(self.annotations[email][img_name]["flags"][flag_name]["bboxes"]):
-                # Update existing bbox with referring expression
-                existing_bbox = self.annotations[email][img_name]["flags"][flag_name]["bboxes"][bbox_index]
-                print(f"Existing bbox: {existing_bbox}")
-                if isinstance(existing_bbox, list):
-                    # Convert simple list to dict with referring expression
-                    self.annotations[email][img_name]["flags"][flag_name]["bboxes"][bbox_index] = {
-                        "coordinates": existing_bbox,
-                        "ref_exp": bbox["referringExpression"]  # Use ref_exp as requested
-                    }
-                    print(f"Converted list to dict with ref_exp: {self.annotations[email][img_name]['flags'][flag_name]['bboxes'][bbox_index]}")
-                else:
-                    # Update existing dict
-                    existing_bbox["ref_exp"] = bbox["referringExpression"]  # Use ref_exp as requested
-                    print(f"Updated existing dict with ref_exp: {existing_bbox}")
-                print(f"Updated bbox {bbox_index} with referring expression: {bbox['referringExpression']}")
-            else:
-                print(f"Warning: Invalid bbox index {bbox_index} for update")
-                return False, f"Invalid bounding box index for update"
+            row = image_entry.find_bbox(flag_name, bbox.get('bboxId'), bbox.get('bboxIndex', -1))
+            if row < 0:
+                print("Warning: Invalid bbox for update")
+                return False, "Invalid bounding box for update", {}
+            
+            image_entry.set_ref_exp(row, bbox["referringExpression"])
+            bbox_id = image_entry.bbox_id(row)
+            print(f"Updated bbox {bbox_id} with referring expression: {bbox['referringExpression']}")
+            message = f"Bounding box updated for {flag_name}!"
         else:
-            # This is a new bbox - check if it's already in the new format
-            if isinstance(bbox, dict) and 'coordinates' in bbox and 'ref_exp' in bbox:
-                # Already in new format, just add it
-                self.annotations[email][img_name]["flags"][flag_name]["bboxes"].append(bbox)
-                print(f"Added new bbox in new format to {flag_name}, total bboxes: {len(self.annotations[email][img_name]['flags'][flag_name]['bboxes'])}")
+            # This is a new bbox - legacy lists are converted with an empty ref_exp
+            if isinstance(bbox, dict) and 'coordinates' in bbox:
+                coordinates, ref_exp, bbox_id = bbox["coordinates"], bbox.get("ref_exp", ""), bbox.get("id")
             else:
-                # Convert old format to new format with empty ref_exp
-                new_bbox = {
-                    "coordinates": bbox,
-                    "ref_exp": ""
-                }
-                self.annotations[email][img_name]["flags"][flag_name]["bboxes"].append(new_bbox)
-                print(f"Converted and added new bbox to {flag_name} with empty ref_exp, total bboxes: {len(self.annotations[email][img_name]['flags'][flag_name]['bboxes'])}")
+                coordinates, ref_exp, bbox_id = bbox, "", None
+            
+            if not (isinstance(coordinates, list) and len(coordinates) == 4 and
+                    all(isinstance(v, (int, float)) for v in coordinates)):
+                return False, "Invalid bounding box coordinates", {}
+            
+            # Keep a client-supplied id so queued follow-up edits can address the box
+            if bbox_id is None:
+                bbox_id = new_bbox_id()
+            elif not is_valid_bbox_id(bbox_id):
+                return False, "Invalid bounding box id", {}
+            elif image_entry.find_bbox(flag_name, bbox_id) >= 0:
+                return False, f"Bounding box {bbox_id} already exists", {"bbox_id": bbox_id}
+            
+            # Initialize the flag only once the box is known to be valid
+            if not image_entry.has_flag(flag_name):
+                image_entry.set_flag_timestamp(flag_name, datetime.now().isoformat())
+                print(f"Created new flag entry for {flag_name}")
+            image_entry.append_bboxes(flag_name, [coordinates], [bbox_id], ref_exps=[ref_exp])
+            print(f"Added new bbox {bbox_id} to {flag_name}, total bboxes: {len(image_entry.flag_rows(flag_name))}")
+            message = f"Bounding box added for {flag_name}!"
         
-        self.annotations[email][img_name]["flags"][flag_name]["timestamp"] = datetime.now().isoformat()
-        self.annotations[email][img_name]["last_updated"] = datetime.now().isoformat()
+        image_entry.set_flag_timestamp(flag_name, datetime.now().isoformat())
+        image_entry.last_updated = datetime.now().isoformat()
         
         # Update last annotated image and last selected flag for the user
         if email in self.users:
             self.users[email]["last_annotated_image"] = img_name
             self.users[email]["last_selected_flag"] = flag_name
         
-        # Save to file immediately
-        print("Saving data to file...")
-        print(f"Final annotations structure for {email}, {img_name}: {self.annotations[email][img_name]}")
-        self.save_data()
-        print("Data saved successfully")
-        
-        return True, f"Bounding box {'updated' if isinstance(bbox, dict) else 'added'} for {flag_name}!"
+        return True, message, {"bbox_id": bbox_id}
     
-    def update_referring_expression(self, email: str, img_name: str, flag_name: str, bbox_index: int, referring_expression: str) -> Tuple[bool, str]:
+    def update_referring_expression(self, email: str, img_name: str, flag_name: str, bbox_index: Optional[int],
+                                    referring_expression: str, bbox_id: Optional[str] = None,
+                                    expected_version: Optional[int] = None,
+                                    idempotency_key: Optional[str] = None) -> Tuple[bool, str, Dict]:
         """Update referring expression for an existing bounding box"""
-        print(f"Updating referring expression for {email}, {img_name}, {flag_name}, bbox {bbox_index}: {referring_expression}")
-        
-        # Create user annotation entry if it doesn't exist
-        if email not in self.annotations:
-            self.annotations[email] = {}
-            print(f"Created new user entry for {email}")
-        
-        if img_name not in self.annotations[email]:
-            self.annotations[email][img_name] = {"flags": {}, "last_updated": ""}
-            print(f"Created new image entry for {img_name}")
+        return self._apply_write(email, img_name, expected_version, idempotency_key,
+                                 lambda image_entry: self._update_referring_expression(image_entry, email, img_name, flag_name, bbox_index,
+                                                                           referring_expression, bbox_id))
+    
+    def _update_referring_expression(self, image_entry: ImageAnnotations, email: str, img_name: str,
+                                     flag_name: str, bbox_index: Optional[int],
+                                     referring_expression: str, bbox_id: Optional[str]) -> Tuple[bool, str, Dict]:
+        print(f"Updating referring expression for {email}, {img_name}, {flag_name}, bbox {bbox_id or bbox_index}: {referring_expression}")
         
-        if flag_name not in self.annotations[email][img_name]["flags"]:
+        if not image_entry.has_flag(flag_name):
             print(f"Warning: Flag {flag_name} not found for {img_name}")
-            return False, f"Flag {flag_name} not found"
+            return False, f"Flag {flag_name} not found", {}
         
-        bboxes = self.annotations[email][img_name]["flags"][flag_name]["bboxes"]
-        if bbox_index < 0 or bbox_index >= len(bboxes):
-            print(f"Warning: Invalid bbox index {bbox_index}")
-            return False, f"Invalid bounding box index {bbox_index}"
+        row = image_entry.find_bbox(flag_name, bbox_id, bbox_index)
+        if row < 0:
+            print(f"Warning: Invalid bbox {bbox_id or bbox_index}")
+            return False, f"Invalid bounding box {bbox_id or bbox_index}", {}
         
         # Update the referring expression
-        existing_bbox = bboxes[bbox_index]
-        if isinstance(existing_bbox, list):
-            # Convert old format to new format
-            bboxes[bbox_index] = {
-                "coordinates": existing_bbox,
-                "ref_exp": referring_expression
-            }
-            print(f"Converted bbox {bbox_index} from list to dict with ref_exp: {referring_expression}")
-        else:
-            # Update existing format
-            existing_bbox["ref_exp"] = referring_expression
-            print(f"Updated bbox {bbox_index} with ref_exp: {referring_expression}")
+        image_entry.set_ref_exp(row, referring_expression)
+        bbox_id = image_entry.bbox_id(row)
+        print(f"Updated bbox {bbox_id} with ref_exp: {referring_expression}")
         
         # Update timestamps
-        self.annotations[email][img_name]["flags"][flag_name]["timestamp"] = datetime.now().isoformat()
-        self.annotations[email][img_name]["last_updated"] = datetime.now().isoformat()
-        
-        # Save to file immediately
-        print("Saving referring expression update to file...")
-        self.save_data()
-        print("Referring expression update saved successfully")
+        image_entry.set_flag_timestamp(flag_name, datetime.now().isoformat())
+        image_entry.last_updated = datetime.now().isoformat()
         
-        return True, f"Referring expression updated for {flag_name}!"
+        return True, f"Referring expression updated for {flag_name}!", {"bbox_id": bbox_id}
     
-    def remove_annotation(self, email: str, img_name: str, flag_name: str, bbox_index: int = None) -> Tuple[bool, str]:
+    def remove_annotation(self, email: str, img_name: str, flag_name: str, bbox_index: int = None,
+                          bbox_id: Optional[str] = None, expected_version: Optional[int] = None,
+                          idempotency_key: Optional[str] = None) -> Tuple[bool, str, Dict]:
         """Remove annotation for a specific flag and image"""
-        # Create user annotation entry if it doesn't exist
-        if email not in self.annotations:
-            self.annotations[email] = {}
+        return self._apply_write(email, img_name, expected_version, idempotency_key,
+                                 lambda image_entry: self._remove_annotation(image_entry, flag_name, bbox_index, bbox_id))
+    
+    def _remove_annotation(self, image_entry: ImageAnnotations, flag_name: str, bbox_index: Optional[int],
+                           bbox_id: Optional[str]) -> Tuple[bool, str, Dict]:
+        if not image_entry.has_flag(flag_name):
+            return False, f"No annotation found for {flag_name}!", {}
         
-        if img_name not in self.annotations[email]:
-            self.annotations[email][img_name] = {"flags": {}, "last_updated": ""}
+        if bbox_index is not None or bbox_id:
+            # Remove specific bounding box
+            row = image_entry.find_bbox(flag_name, bbox_id, bbox_index)
+            if row < 0:
+                return False, f"Invalid bounding box for {flag_name}", {}
+            image_entry.remove_bbox(row)
+            if not len(image_entry.flag_rows(flag_name)):  # If no more bboxes, remove the flag entirely
+                image_entry.remove_flag(flag_name)
+        else:
+            # Remove entire flag
+            image_entry.remove_flag(flag_name)
+        
+        image_entry.last_updated = datetime.now().isoformat()
+        return True, f"Annotation removed for {flag_name}!", {}
+    
+    def _resolve_flag(self, label, label_map: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """Map a model label (name or index into the flag list) onto a flag name"""
+        if label_map and str(label) in label_map:
+            label = label_map[str(label)]
+        if not isinstance(label, (int, str)):
+            return None
+        if isinstance(label, int) and not isinstance(label, bool):
+            flag_names = list(self.flags)
+            return flag_names[label] if 0 <= label < len(flag_names) else None
+        if label in self.flags:
+            return label
+        for flag_name in self.flags:
+            if flag_name.lower() == str(label).strip().lower():
+                return flag_name
+        return None
+    
+    def _get_image_size(self, img_name: str) -> Tuple[int, int]:
+        """Read (width, height) of an image in the loaded user folder, or (0, 0) if unavailable"""
+        if self.images_dir:
+            img_path = os.path.join(self.images_dir, img_name)
+            try:
+                with Image.open(img_path) as img:  # Only the header is read
+                    return img.size
+            except OSError:
+                pass
+        return 0, 0
+    
+    def _iter_jsonl_predictions(self, stream):
+        """Yield (image, label, bbox, score, width, height, id) from a JSONL prediction stream.
+        
+        Each line is an object with ``image``, ``label`` and a pixel ``bbox`` of
+        [x1, y1, x2, y2]; ``score``, ``width``, ``height`` and ``id`` are optional.
+        """
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            if not isinstance(record, dict):
+                yield None
+                continue
+            yield (record.get("image"), record.get("label"), record.get("bbox"), record.get("score"),
+                   record.get("width"), record.get("height"), record.get("id"))
+    
+    def _iter_coco_predictions(self, stream):
+        """Yield (image, label, bbox, score, width, height, id) from a COCO-format prediction file.
+        
+        Boxes are COCO [x, y, width, height] in pixels and are converted to
+        [x1, y1, x2, y2]. A ``category_id`` missing from ``categories`` gives a None
+        label. The file is a single JSON document, so it is parsed whole.
+        """
+        coco = json.load(stream)
+        if not isinstance(coco, dict):
+            raise ValueError("COCO file must be a JSON object")
+        images = {img.get("id"): img for img in coco.get("images", []) if isinstance(img, dict)}
+        categories = {cat.get("id"): cat.get("name") for cat in coco.get("categories", []) if isinstance(cat, dict)}
+        for ann in coco.get("annotations", []):
+            if not isinstance(ann, dict):
+                yield None
+                continue
+            img = images.get(ann.get("image_id"), {})
+            bbox = ann.get("bbox")
+            if isinstance(bbox, list) and len(bbox) == 4:
+                x, y, w, h = bbox
+                bbox = [x, y, x + w, y + h] if all(isinstance(v, (int, float)) for v in bbox) else None
+            yield (img.get("file_name"), categories.get(ann.get("category_id")),
+                   bbox, ann.get("score"), img.get("width"), img.get("height"), ann.get("id"))
+    
+    def _normalize_prediction_batch(self, coords: List, sizes: List, scores: List,
+                                    min_score: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Validate pixel boxes and convert them to the 1-1000 normalized space.
+        
+        Returns the normalized int boxes, a mask of the rows that are valid and a mask
+        of the rows scoring at least ``min_score`` (or with no score).
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+        sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+        scores = np.asarray(scores, dtype=np.float64)
+        
+        valid = np.isfinite(coords).all(axis=1) & (sizes > 0).all(axis=1)
+        valid &= (coords[:, 2] > coords[:, 0]) & (coords[:, 3] > coords[:, 1])
+        confident = np.isnan(scores) | (scores >= min_score)
+        
+        # Clamp like normalizeCoordinate() in the annotation page; floor(x + 0.5) matches
+        # Math.round(), which rounds halves up where np.rint would round them to even
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled = coords / np.tile(sizes, 2) * 1000
+        normalized = np.clip(np.floor(np.nan_to_num(scaled) + 0.5), 1, 1000).astype(np.int64)
+        valid &= (normalized[:, 2] > normalized[:, 0]) & (normalized[:, 3] > normalized[:, 1])
+        return normalized, valid, confident
+    
+    def _prediction_bbox_ids(self, img_name: str, flag_name: str, prediction_ids: List, coords: np.ndarray) -> List[str]:
+        """Derive stable bbox ids for imported predictions.
         
-        if (img_name in self.annotations[email] and 
-            flag_name in self.annotations[email][img_name]["flags"]):
+        The id hashes the image, flag, the prediction's own id (if any) and its normalized
+        box, so importing the same predictions again yields the same ids.
+        """
+        return [hashlib.blake2b(json.dumps([img_name, flag_name, prediction_id, box], default=str).encode(),
+                                digest_size=BBOX_ID_LENGTH // 2).hexdigest()
+                for prediction_id, box in zip(prediction_ids, coords.tolist())]
+    
+    def import_predictions(self, email: str, stream, fmt: str = "jsonl",
+                           label_map: Optional[Dict[str, str]] = None, min_score: float = 0.0,
+                           batch_size: int = 100000) -> Tuple[bool, str, Dict]:
+        """Import model predictions as machine-proposed bounding boxes for a user.
+        
+        Predictions are streamed and converted in batches. Nothing is applied until the
+        whole file has parsed; then all boxes are added and written with a single
+        save_data() call. Imported boxes carry ``"source": "model"`` and the model score.
+        Box ids are derived from the predictions, and boxes whose id is already present
+        are skipped, so re-running an import does not duplicate boxes.
+        """
+        if fmt == "jsonl":
+            predictions = self._iter_jsonl_predictions(stream)
+        elif fmt == "coco":
+            predictions = self._iter_coco_predictions(stream)
+        else:
+            return False, f"Unsupported prediction format: {fmt}", {}
+        if label_map is not None and not isinstance(label_map, dict):
+            return False, "Label map must be a JSON object", {}
+        if email not in self.users:
+            return False, f"User {email} is not registered", {}
+        
+        stats = {"imported": 0, "skipped_invalid": 0, "skipped_label": 0, "skipped_score": 0,
+                 "skipped_duplicate": 0, "skipped_read_only": 0, "images": 0}
+        image_sizes = {}
+        flag_cache = {}
+        staged = {}  # (image, flag) -> list of (normalized boxes, scores) batches
+        
+        def flush(batch):
+            if not batch["coords"]:
+                return
+            normalized, valid, confident = self._normalize_prediction_batch(
+                batch["coords"], batch["sizes"], batch["scores"], min_score)
+            stats["skipped_invalid"] += int((~valid).sum())
+            stats["skipped_score"] += int((valid & ~confident).sum())
+            scores = np.asarray(batch["scores"], dtype=np.float64)
             
-            if bbox_index is not None:
-                # Remove specific bounding box
-                bboxes = self.annotations[email][img_name]["flags"][flag_name]["bboxes"]
-                if 0 <= bbox_index < len(bboxes):
-                    bboxes.pop(bbox_index)
-                    if not bboxes:  # If no more bboxes, remove the flag entirely
-                        del self.annotations[email][img_name]["flags"][flag_name]
-                else:
-                    return False, f"Invalid bounding box index for {flag_name}"
-            else:
-                # Remove entire flag
-                del self.annotations[email][img_name]["flags"][flag_name]
+            # Group kept rows by (image, flag) so each store grows once per batch
+            groups = {}
+            for row in np.flatnonzero(valid & confident).tolist():
+                groups.setdefault(batch["keys"][row], []).append(row)
+            for key, rows in groups.items():
+                bbox_ids = self._prediction_bbox_ids(*key, [batch["ids"][row] for row in rows], normalized[rows])
+                staged.setdefault(key, []).append((normalized[rows], scores[rows], bbox_ids))
+            for values in batch.values():
+                values.clear()
+        
+        try:
+            batch = {"keys": [], "coords": [], "sizes": [], "scores": [], "ids": []}
+            for prediction in predictions:
+                if prediction is None:
+                    stats["skipped_invalid"] += 1
+                    continue
+                img_name, label, bbox, score, width, height, prediction_id = prediction
+                if not isinstance(img_name, str) or not img_name or not isinstance(bbox, list) or len(bbox) != 4:
+                    stats["skipped_invalid"] += 1
+                    continue
+                img_name = os.path.basename(img_name)
+                
+                if label is None:
+                    stats["skipped_label"] += 1
+                    continue
+                if not isinstance(label, (int, str)):
+                    label = str(label)
+                if label not in flag_cache:
+                    flag_cache[label] = self._resolve_flag(label, label_map)
+                flag_name = flag_cache[label]
+                if flag_name is None:
+                    stats["skipped_label"] += 1
+                    continue
+                
+                if not (width and height):
+                    if img_name not in image_sizes:
+                        image_sizes[img_name] = self._get_image_size(img_name)
+                    width, height = image_sizes[img_name]
+                
+                try:
+                    coords = [float(v) for v in bbox]
+                    size = [float(width), float(height)]
+                    score = float("nan") if score is None else float(score)
+                except (TypeError, ValueError):
+                    stats["skipped_invalid"] += 1
+                    continue
+                batch["keys"].append((img_name, flag_name))
+                batch["coords"].append(coords)
+                batch["sizes"].append(size)
+                batch["scores"].append(score)
+                batch["ids"].append(prediction_id)
+                
+                if len(batch["keys"]) >= batch_size:
+                    flush(batch)
+            flush(batch)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f"Error: Failed to parse predictions: {e}")
+            return False, f"Invalid prediction file: {e}", stats
+        
+        if not staged:
+            return False, "No valid predictions to import", stats
+        
+        with self.write_lock:
+            timestamp = datetime.now().isoformat()
+            touched = set()
+            for (img_name, flag_name), parts in staged.items():
+                if (email, img_name) in self.raw_images:
+                    stats["skipped_read_only"] += sum(len(part[2]) for part in parts)
+                    continue
+                coords = np.concatenate([part[0] for part in parts])
+                scores = np.concatenate([part[1] for part in parts])
+                bbox_ids = np.array([bbox_id for part in parts for bbox_id in part[2]], dtype=BBOX_ID_DTYPE)
+                
+                # Keep the first box for each id, minus ids the flag already has
+                _, first_rows = np.unique(bbox_ids, return_index=True)
+                keep = np.zeros(len(bbox_ids), dtype=bool)
+                keep[first_rows] = True
+                image_entry = self.annotations.get(email, {}).get(img_name)
+                if image_entry is not None and image_entry.has_flag(flag_name):
+                    keep &= ~np.isin(bbox_ids, image_entry.bbox_ids[image_entry.flag_rows(flag_name)])
+                stats["skipped_duplicate"] += int((~keep).sum())
+                if not keep.any():
+                    continue
+                
+                image_entry = self._get_or_create_image_entry(email, img_name)
+                image_entry.set_flag_timestamp(flag_name, timestamp)
+                image_entry.append_bboxes(flag_name, coords[keep], [bbox_id.decode("ascii") for bbox_id in bbox_ids[keep]],
+                                          sources=["model"] * int(keep.sum()), scores=scores[keep])
+                stats["imported"] += int(keep.sum())
+                touched.add(img_name)
             
-            self.annotations[email][img_name]["last_updated"] = datetime.now().isoformat()
-            self.save_data()
-            return True, f"Annotation removed for {flag_name}!"
+            for img_name in touched:
+                image_entry = self.annotations[email][img_name]
+                image_entry.version += 1
+                image_entry.last_updated = timestamp
+                self.dirty_images.add((email, img_name))
+            stats["images"] = len(touched)
+            
+            if touched:
+                self.save_data()
         
-        return False, f"No annotation found for {flag_name}!"
+        print(f"Imported {stats['imported']} predicted bounding boxes for {email} across {stats['images']} images")
+        return True, f"Imported {stats['imported']} predicted bounding boxes", stats
     
     def update_last_selected_flag(self, email: str, flag_name: str) -> bool:
         """Update the last selected flag for a user"""
@@ -489,6 +927,27 @@ def serve_image(filename):
     """Serve images from the configured images directory"""
     return send_from_directory(annotation_system.images_dir, filename)
 
+def update_session_annotations(user_email: str, img_name: str):
+    """Mirror the stored annotations for one image into the session"""
+    user_annotations = session.get('annotations', {})
+    user_annotations[img_name] = annotation_system.get_image_annotations(user_email, img_name)
+    session['annotations'] = user_annotations
+
+def write_response(success: bool, message: str, data: Dict):
+    """Build the JSON response for an annotation write, using 409 for version conflicts"""
+    response = jsonify({'success': success, 'message': message, **data})
+    if data.get('conflict'):
+        return response, 409
+    return response
+
+def get_idempotency_key(data: Dict) -> Optional[str]:
+    """Read the client-supplied idempotency key from the header or the request body"""
+    return request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+
+def is_optional_int(value) -> bool:
+    """Check that a request field is absent or an integer (JSON booleans are rejected)"""
+    return value is None or (isinstance(value, int) and not isinstance(value, bool))
+
 @app.route('/api/save_annotation', methods=['POST'])
 def api_save_annotation():
     if 'user_email' not in session:
@@ -503,23 +962,21 @@ def api_save_annotation():
     if not all([img_name, flag_name, bbox]):
         return jsonify({'success': False, 'message': 'Missing required data'})
     
-    success, message = annotation_system.save_annotation(user_email, img_name, flag_name, bbox)
+    bbox_index = bbox.get('bboxIndex') if isinstance(bbox, dict) else None
+    if not (is_optional_int(data.get('expected_version')) and is_optional_int(bbox_index)):
+        return jsonify({'success': False, 'message': 'expected_version and bboxIndex must be integers'})
+    
+    success, message, result = annotation_system.save_annotation(
+        user_email, img_name, flag_name, bbox,
+        expected_version=data.get('expected_version'),
+        idempotency_key=get_idempotency_key(data)
+    )
     
     # Update session annotations after saving
     if success:
-        user_annotations = session.get('annotations', {})
-        if img_name not in user_annotations:
-            user_annotations[img_name] = {"flags": {}, "last_updated": ""}
-        
-        if flag_name not in user_annotations[img_name]["flags"]:
-            user_annotations[img_name]["flags"][flag_name] = {"bboxes": [], "timestamp": ""}
-        
-        user_annotations[img_name]["flags"][flag_name]["bboxes"].append(bbox)
-        user_annotations[img_name]["flags"][flag_name]["timestamp"] = datetime.now().isoformat()
-        user_annotations[img_name]["last_updated"] = datetime.now().isoformat()
-        session['annotations'] = user_annotations
+        update_session_annotations(user_email, img_name)
     
-    return jsonify({'success': success, 'message': message})
+    return write_response(success, message, result)
 
 @app.route('/api/update_referring_expression', methods=['POST'])
 def api_update_referring_expression():
@@ -532,39 +989,28 @@ def api_update_referring_expression():
     img_name = data.get('image_name')
     flag_name = data.get('flag_name')
     bbox_index = data.get('bbox_index')
+    bbox_id = data.get('bbox_id')
     referring_expression = data.get('referring_expression')
     
-    if not all([img_name, flag_name, bbox_index is not None, referring_expression]):
+    if not all([img_name, flag_name, bbox_id or bbox_index is not None, referring_expression]):
         return jsonify({'success': False, 'message': 'Missing required data'})
     
+    if not (is_optional_int(data.get('expected_version')) and is_optional_int(bbox_index)):
+        return jsonify({'success': False, 'message': 'expected_version and bbox_index must be integers'})
+    
     # Update the referring expression in the backend
-    success, message = annotation_system.update_referring_expression(
-        user_email, img_name, flag_name, bbox_index, referring_expression
+    success, message, result = annotation_system.update_referring_expression(
+        user_email, img_name, flag_name, bbox_index, referring_expression,
+        bbox_id=bbox_id,
+        expected_version=data.get('expected_version'),
+        idempotency_key=get_idempotency_key(data)
     )
     
     # Update session annotations after saving
     if success:
-        user_annotations = session.get('annotations', {})
-        if (img_name in user_annotations and 
-            flag_name in user_annotations[img_name]["flags"] and
-            bbox_index < len(user_annotations[img_name]["flags"][flag_name]["bboxes"])):
-            
-            bbox = user_annotations[img_name]["flags"][flag_name]["bboxes"][bbox_index]
-            if isinstance(bbox, list):
-                # Convert old format to new format
-                user_annotations[img_name]["flags"][flag_name]["bboxes"][bbox_index] = {
-                    "coordinates": bbox,
-                    "ref_exp": referring_expression
-                }
-            else:
-                # Update existing format
-                bbox["ref_exp"] = referring_expression
-            
-            user_annotations[img_name]["flags"][flag_name]["timestamp"] = datetime.now().isoformat()
-            user_annotations[img_name]["last_updated"] = datetime.now().isoformat()
-            session['annotations'] = user_annotations
+        update_session_annotations(user_email, img_name)
     
-    return jsonify({'success': success, 'message': message})
+    return write_response(success, message, result)
 
 @app.route('/api/remove_annotation', methods=['POST'])
 def api_remove_annotation():
@@ -576,31 +1022,26 @@ def api_remove_annotation():
     img_name = data.get('image_name')
     flag_name = data.get('flag_name')
     bbox_index = data.get('bbox_index')
+    bbox_id = data.get('bbox_id')
     
     if not all([img_name, flag_name]):
         return jsonify({'success': False, 'message': 'Missing required data'})
     
-    success, message = annotation_system.remove_annotation(user_email, img_name, flag_name, bbox_index)
+    if not (is_optional_int(data.get('expected_version')) and is_optional_int(bbox_index)):
+        return jsonify({'success': False, 'message': 'expected_version and bbox_index must be integers'})
+    
+    success, message, result = annotation_system.remove_annotation(
+        user_email, img_name, flag_name, bbox_index,
+        bbox_id=bbox_id,
+        expected_version=data.get('expected_version'),
+        idempotency_key=get_idempotency_key(data)
+    )
     
     # Update session annotations after removing
     if success:
-        user_annotations = session.get('annotations', {})
-        if img_name in user_annotations and flag_name in user_annotations[img_name]["flags"]:
-            if bbox_index is not None:
-                # Remove specific bounding box
-                bboxes = user_annotations[img_name]["flags"][flag_name]["bboxes"]
-                if 0 <= bbox_index < len(bboxes):
-                    bboxes.pop(bbox_index)
-                    if not bboxes:  # If no more bboxes, remove the flag entirely
-                        del user_annotations[img_name]["flags"][flag_name]
-            else:
-                # Remove entire flag
-                del user_annotations[img_name]["flags"][flag_name]
-            
-            user_annotations[img_name]["last_updated"] = datetime.now().isoformat()
-            session['annotations'] = user_annotations
+        update_session_annotations(user_email, img_name)
     
-    return jsonify({'success': True, 'message': message})
+    return write_response(success, message, result)
 
 @app.route('/api/get_annotations/<image_name>')
 def api_get_annotations(image_name):
@@ -656,6 +1097,33 @@ def api_update_last_flag():
     success = annotation_system.update_last_selected_flag(user_email, flag_name)
     return jsonify({'success': success, 'message': 'Flag updated' if success else 'Failed to update flag'})
 
+@app.route('/api/import_predictions', methods=['POST'])
+def api_import_predictions():
+    """Import an uploaded JSONL or COCO prediction file as pre-labels for the logged in user"""
+    if 'user_email' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'})
+    
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({'success': False, 'message': 'Missing prediction file'})
+    
+    fmt = request.form.get('format') or ('jsonl' if upload.filename.lower().endswith('.jsonl') else 'coco')
+    try:
+        label_map = json.loads(request.form['label_map']) if request.form.get('label_map') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Label map must be valid JSON'})
+    if label_map is not None and not isinstance(label_map, dict):
+        return jsonify({'success': False, 'message': 'Label map must be a JSON object'})
+    try:
+        min_score = float(request.form.get('min_score', 0.0))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Minimum score must be a number'})
+    
+    success, message, stats = annotation_system.import_predictions(
+        session['user_email'], upload.stream, fmt, label_map=label_map, min_score=min_score
+    )
+    return jsonify({'success': success, 'message': message, **stats})
+
 @app.route('/api/refresh_annotations')
 def api_refresh_annotations():
     if 'user_email' not in session:
@@ -691,6 +1159,11 @@ if __name__ == '__main__':
     parser.add_argument('--host', default='0.0.0.0', help='Host to run the app on')
     parser.add_argument('--port', type=int, default=7865, help='Port to run the app on')
     parser.add_argument('--debug', action='store_true', help='Run in debug mode')
+    parser.add_argument('--import-predictions', type=str, help='Import a JSONL or COCO prediction file as pre-labels and exit')
+    parser.add_argument('--import-email', type=str, help='Email of the user to receive imported pre-labels')
+    parser.add_argument('--import-format', choices=['jsonl', 'coco'], help='Prediction file format (default: from file extension)')
+    parser.add_argument('--label-map', type=str, help='JSON file mapping model labels to flag names')
+    parser.add_argument('--min-score', type=float, default=0.0, help='Skip predictions scoring below this value')
     
     args = parser.parse_args()
     
@@ -704,4 +1177,27 @@ if __name__ == '__main__':
         print("Usage: python app.py --user-folder sft_splits/user1")
         sys.exit(1)
     
+    if args.import_predictions:
+        if not args.import_email:
+            print("Error: --import-email is required with --import-predictions")
+            sys.exit(1)
+        
+        fmt = args.import_format or ('jsonl' if args.import_predictions.lower().endswith('.jsonl') else 'coco')
+        label_map = None
+        if args.label_map:
+            with open(args.label_map, 'r') as f:
+                label_map = json.load(f)
+            if not isinstance(label_map, dict):
+                print("Error: --label-map must contain a JSON object")
+                sys.exit(1)
+        
+        with open(args.import_predictions, 'r') as f:
+            success, message, stats = annotation_system.import_predictions(
+                args.import_email, f, fmt, label_map=label_map, min_score=args.min_score
+            )
+        print(message)
+        print(f"Skipped {stats.get('skipped_invalid', 0)} invalid, {stats.get('skipped_label', 0)} unmapped, "
+              f"{stats.get('skipped_score', 0)} low-scoring and {stats.get('skipped_duplicate', 0)} already imported predictions")
+        sys.exit(0 if success else 1)
+    
     app.run(host=args.host, port=args.port, debug=args.debug)
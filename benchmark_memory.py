@@ -0,0 +1,86 @@
+"""Compare resident memory of dict-based and columnar annotation storage.
+
+Builds synthetic annotations shaped like outputs/annotations.json and measures the
+Python heap (via tracemalloc) needed to hold them as nested dicts and as
+ImageAnnotations stores.
+
+Usage: python benchmark_memory.py --boxes 200000 --images 2000
+
+Tracing makes large runs slow; bytes per box is the figure that scales to millions of boxes.
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+from datetime import datetime, timedelta
+
+from annotation_store import ImageAnnotations, StringTable, new_bbox_id
+
+FLAGS = ["Shadows", "Lighting Match", "Color Cast Consistency", "Relative Size / Scale",
+         "Front–Back Overlap", "Edges & Boundaries (cut-out / halo check)", "Other"]
+
+
+def generate_image(rng: random.Random, boxes: int, ref_exp_fraction: float) -> dict:
+    """Generate one image entry in the JSON shape, as json.load would return it"""
+    now = datetime(2025, 1, 1) + timedelta(seconds=rng.randrange(10 ** 7), microseconds=rng.randrange(10 ** 6))
+    flags = {}
+    for i in range(boxes):
+        flag = flags.setdefault(rng.choice(FLAGS), {"bboxes": [], "timestamp": now.isoformat()})
+        x1, y1 = rng.randint(1, 900), rng.randint(1, 900)
+        bbox = {
+            "id": new_bbox_id(),
+            "coordinates": [x1, y1, rng.randint(x1 + 1, 1000), rng.randint(y1 + 1, 1000)],
+            "ref_exp": f"the object near region {rng.randrange(10 ** 6)}" if rng.random() < ref_exp_fraction else "",
+            "source": "model",
+            "score": rng.random()
+        }
+        flag["bboxes"].append(bbox)
+    return {"flags": flags, "last_updated": now.isoformat(), "version": 1}
+
+
+def measure(build) -> tuple:
+    """Return (bytes held after build, result) for a zero-argument builder"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotation storage memory benchmark')
+    parser.add_argument('--boxes', type=int, default=200000, help='Total number of bounding boxes')
+    parser.add_argument('--images', type=int, default=2000, help='Number of images the boxes are spread over')
+    parser.add_argument('--ref-exp-fraction', type=float, default=0.1,
+                        help='Fraction of boxes with a (unique) referring expression')
+    args = parser.parse_args()
+
+    per_image = max(1, args.boxes // args.images)
+
+    def build_dicts():
+        rng = random.Random(0)
+        return {f"img{i}.jpg": generate_image(rng, per_image, args.ref_exp_fraction) for i in range(args.images)}
+
+    def build_stores():
+        rng = random.Random(0)
+        strings = StringTable()
+        return strings, {f"img{i}.jpg": ImageAnnotations.from_dict(generate_image(rng, per_image, args.ref_exp_fraction), strings)
+                         for i in range(args.images)}
+
+    dict_bytes, dicts = measure(build_dicts)
+    del dicts
+    store_bytes, (strings, stores) = measure(build_stores)
+    array_bytes = sum(store.nbytes() for store in stores.values())
+
+    total = per_image * args.images
+    print(f"Boxes: {total} across {args.images} images")
+    print(f"Dict representation:     {dict_bytes / 2 ** 20:8.1f} MB ({dict_bytes / total:.0f} bytes/box)")
+    print(f"Columnar representation: {store_bytes / 2 ** 20:8.1f} MB ({store_bytes / total:.0f} bytes/box)")
+    print(f"  of which arrays:       {array_bytes / 2 ** 20:8.1f} MB, interned strings: {len(strings)}")
+    print(f"Reduction: {dict_bytes / store_bytes:.1f}x")
+
+
+if __name__ == '__main__':
+    main()